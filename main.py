@@ -1,10 +1,142 @@
-from netCDF4 import Dataset
-import numpy as np
-import pandas as pd
-import time as t
+from datetime import datetime, timezone
+from itertools import islice
+import os
 import argparse
 
 
+# maximum number of records read from the CSV at a time, also used as the
+# maximum netcdf chunk size along the time dimension
+MAX_CHUNK_RECORDS = 1 << 16
+
+# columns read from the input CSV, and their types. Flag meanings repeat a lot, so are categorical
+CSV_COLUMNS = ['Time (UTC)', 'Ozone Concentration (ppb)', 'Quality Control Falg Value', 'Quality Control Flag Meaning']
+CSV_DTYPES = {'Ozone Concentration (ppb)': 'float32',
+              'Quality Control Falg Value': 'int32',
+              'Quality Control Flag Meaning': 'category'}
+
+# candidate formats for the CSV 'Time (UTC)' column, tried in order
+TIME_FORMATS = ('%d/%m/%Y %H:%M', '%d/%m/%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S')
+
+
+def detect_time_format(value):
+    """
+    Returns the first format in TIME_FORMATS that parses value, or None if no candidate matches.
+    """
+    for fmt in TIME_FORMATS:
+        try:
+            datetime.strptime(value.strip(), fmt)
+        except ValueError:
+            continue
+        return fmt
+    return None
+
+
+def seconds_past_midnight(epoch):
+    """
+    Returns seconds past midnight UTC as a float64 array, from an int64 array of seconds since 1970-01-01.
+    """
+    import numpy as np
+
+    # single pass, writing straight into the float64 output rather than an int64 temporary
+    return np.remainder(epoch, 86400, out = np.empty(epoch.shape, dtype = np.float64))
+
+
+def parse_times(times, time_format):
+    """
+    Returns seconds since 1970-01-01 UTC as an int64 array, from a Series of time strings.
+    time_format is from detect_time_format, if None pandas works out the format itself.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if time_format is None:
+        # unknown format, fall back to letting pandas work it out
+        times = pd.to_datetime(times, utc = True, dayfirst = True)
+    else:
+        times = pd.to_datetime(times, utc = True, format = time_format, cache = True)
+    return times.values.astype('datetime64[s]').astype(np.int64)
+
+
+def format_epoch(epoch_seconds):
+    """
+    Returns date and time strings, in formats %Y-%m-%d and %H:%M:%S, for seconds since 1970-01-01 UTC.
+    """
+    import numpy as np
+
+    date, time = np.datetime64(int(epoch_seconds), 's').item().isoformat(sep = ' ').split(' ')
+    return date, time
+
+
+def create_ozone_netcdf(out_file, header, expected_format, start_epoch, chunk_records):
+    """
+    Creates netCDF file with global attributes, time dimension and empty variables, ready for data.
+    Attributes that depend on the whole file, end_time and the qc flag values and meanings, are not set.
+    Input options
+     out_file        - string. Name of output netCDF file.
+     header          - list. Rows from top of CSV file, used for attributes if expected_format.
+     expected_format - bool. See make_ozone_netcdf.
+     start_epoch     - integer. Time of first data point, seconds since 1970-01-01 UTC.
+     chunk_records   - integer. Chunk size of variables along the time dimension.
+    Output
+     netCDF4 Dataset, open for writing.
+    """
+    from netCDF4 import Dataset
+
+    start_data_date, start_data_time = format_epoch(start_epoch)
+
+    # build global attributes up front so they are written in one go
+    if expected_format:
+        global_attrs = {'title': f'{header[0]} Data',
+                        'instrument_name': header[0],
+                        'contact': header[1],
+                        'description': header[2],
+                        'creator': header[3]}
+    else:
+        global_attrs = {'title': 'Ozone Concentration Data'}
+    global_attrs['history'] = f"Created at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')}"
+    global_attrs['start_time'] = f'{start_data_date} {start_data_time}Z'
+
+    # create netcdf file, add global attributes
+    nc_file = Dataset(out_file, 'w', format='NETCDF4', clobber = True, diskless = False)
+    nc_file.setncatts(global_attrs)
+
+    # create dimensions, only Time exists
+    nc_file.createDimension('time', None)
+
+    # light compression on all variables.
+    # Time is unlimited, so size its chunks from the data rather than relying on the small library default
+    var_options = {'chunksizes': (chunk_records,),
+                   'complevel': 1}
+    # netCDF4 only applies the shuffle filter together with zlib, so the low-entropy qc flags, which gain
+    # most from shuffling, always use zlib with shuffle. The float variables use zstd, without shuffle,
+    # if the netcdf library supports it
+    shuffled_options = dict(var_options, compression = 'zlib', shuffle = True)
+    if nc_file.has_zstd_filter():
+        float_options = dict(var_options, compression = 'zstd')
+    else:
+        float_options = shuffled_options
+
+    # create variables
+    time = nc_file.createVariable('time', 'f8', ('time',), **float_options)
+    time.setncatts({'units': f'seconds since {start_data_date} 00:00:00 +00:00'})
+
+    ozone_concentration = nc_file.createVariable('ozone_concentration', 'f4', ('time',), **float_options)
+    ozone_concentration.setncatts({'long_name': 'ozone concentration',
+                                   'units': 'parts per billion'})
+
+    quality_control = nc_file.createVariable('qc_flag', 'i4', ('time',), **shuffled_options)
+    quality_control.long_name = 'quality control flag'
+
+    # data arrays are dense with no fill values, so skip masked array handling on write.
+    # Give each variable a chunk cache large enough to keep its chunks resident while
+    # writing, rather than having HDF5 evict and re-read them between writes
+    for var in (time, ozone_concentration, quality_control):
+        var.set_auto_maskandscale(False)
+        var.set_var_chunk_cache(size = 64 * 1024 * 1024, nelems = 1009, preemption = 0.75)
+
+    return nc_file
+
+
 def make_ozone_netcdf(in_file, out_file = 'ozone_box_interview_data.nc', skiprows = 5, expected_format = True):
     """
     Takes CSV file provided for NCAS interview and converts into netCDF.
@@ -21,63 +153,67 @@ def make_ozone_netcdf(in_file, out_file = 'ozone_box_interview_data.nc', skiprow
     Output
      netcdf file, written to out_file.
     """
-    # open file to get data at top of file
-    with open(in_file, 'r') as f:
-        header = [next(f).strip('\n') for x in range(skiprows)]
-
-    # read rest of file to pandas dataframe, convert time to seconds past midnight
-    df = pd.read_csv(in_file, skiprows = skiprows)
-    df['Time (UTC)'] = pd.to_datetime(df['Time (UTC)'], utc = True, dayfirst = True, infer_datetime_format=True)
-    seconds = [((h.hour * 3600) + (h.minute * 60) + (h.second)) for h in df['Time (UTC)']]
-    df = df.assign(seconds_past_midnight = seconds)
-
-    # get data start and end dates and times
-    start_data_date = df['Time (UTC)'][0].strftime('%Y-%m-%d')
-    start_data_time = df['Time (UTC)'][0].strftime('%H:%M:%S')
-    end_data_date = df['Time (UTC)'].iloc[-1].strftime('%Y-%m-%d')
-    end_data_time = df['Time (UTC)'].iloc[-1].strftime('%H:%M:%S')
-
-    # get quality control values and meanings
-    qc_vals = sorted(set(df['Quality Control Falg Value']))  # yes, Falg not Flag!
-    qc_meanings = []
-    for val in qc_vals:
-        val_index = df.loc[df['Quality Control Falg Value'] == val].index[0]
-        qc_meanings.append(df['Quality Control Flag Meaning'][val_index].replace(' ','_'))
+    import numpy as np
+    import pandas as pd
 
-    # create netcdf file, add global attributes
-    nc_file = Dataset(out_file, 'w', format='NETCDF4_CLASSIC')
-    if expected_format:
-        nc_file.title = f'{header[0]} Data'
-        nc_file.instrument_name = header[0]
-        nc_file.contact = header[1]
-        nc_file.description = header[2]
-        nc_file.creator = header[3]
-    else:
-        nc_file.title = 'Ozone Concentration Data'
-    nc_file.history = f"Created at {t.strftime('%Y-%m-%d %H:%M:%S')}"
-    nc_file.start_time = f'{start_data_date} {start_data_time}Z'
-    nc_file.end_time = f'{end_data_date} {end_data_time}Z'
+    nc_file = None
+    try:
+        # open file to get data at top of file, then stream rest of file from the
+        # same handle in chunks, so memory use does not grow with file length
+        with open(in_file, 'r') as f:
+            header = [line.strip('\n') for line in islice(f, skiprows)]
+            reader = pd.read_csv(f, chunksize = MAX_CHUNK_RECORDS, usecols = CSV_COLUMNS, dtype = CSV_DTYPES)
 
-    # create dimensions, only Time exists
-    nc_file.createDimension('time', None)
+            offset = 0
+            qc_lookup = {}
+            for chunk in reader:
+                if chunk.empty:
+                    continue
 
-    # create variables
-    time = nc_file.createVariable('time', 'f8', ('time',))
-    time.units = f'seconds since {start_data_date} 00:00:00 +00:00'
-
-    ozone_concentration = nc_file.createVariable('ozone_concentration', 'f4', ('time',))
-    ozone_concentration.long_name = 'ozone concentration'
-    ozone_concentration.units = "parts per billion"
-    
-    quality_control = nc_file.createVariable('qc_flag', 'i4', ('time',))
-    quality_control.long_name = 'quality control flag'
-    quality_control.flag_values = qc_vals
-    quality_control.flag_meanings = ' '.join(qc_meanings)
+                # convert time to seconds past midnight, time format is found from the first row
+                if nc_file is None:
+                    time_format = detect_time_format(chunk['Time (UTC)'].iloc[0])
+                epoch = parse_times(chunk['Time (UTC)'], time_format)
+
+                if nc_file is None:
+                    nc_file = create_ozone_netcdf(out_file, header, expected_format, epoch[0], len(chunk))
+                    time = nc_file.variables['time']
+                    ozone_concentration = nc_file.variables['ozone_concentration']
+                    quality_control = nc_file.variables['qc_flag']
+
+                # add data to variables as contiguous arrays matching the netcdf variable types,
+                # appending along the time dimension. Written largest type first
+                n = len(chunk)
+                qc_data = chunk['Quality Control Falg Value'].to_numpy(dtype = np.int32)  # yes, Falg not Flag!
+                time[offset:offset + n] = seconds_past_midnight(epoch)
+                ozone_concentration[offset:offset + n] = chunk['Ozone Concentration (ppb)'].to_numpy(dtype = np.float32)
+                quality_control[offset:offset + n] = qc_data
+                offset += n
+
+                # add to quality control values and meanings, meaning for each value
+                # is taken from its first occurrence in the file
+                chunk_qc_vals, first_index = np.unique(qc_data, return_index = True)
+                meanings_data = chunk['Quality Control Flag Meaning'].to_numpy()
+                for val, i in zip(chunk_qc_vals.tolist(), first_index):
+                    qc_lookup.setdefault(val, meanings_data[i])
+                last_epoch = epoch[-1]
+
+        if nc_file is None:
+            raise ValueError(f'No data found in {in_file}')
 
-    # add data to variables
-    time[:] = df['seconds_past_midnight']
-    ozone_concentration[:] = df['Ozone Concentration (ppb)']
-    quality_control[:] = df['Quality Control Falg Value']
+        # attributes that depend on the whole file can only be set once all data is read
+        end_data_date, end_data_time = format_epoch(last_epoch)
+        nc_file.end_time = f'{end_data_date} {end_data_time}Z'
+        qc_vals = sorted(qc_lookup)
+        qc_meanings = np.char.replace(np.array([qc_lookup[val] for val in qc_vals], dtype = str), ' ', '_').tolist()
+        quality_control.setncatts({'flag_values': np.array(qc_vals, dtype = np.int32),
+                                   'flag_meanings': ' '.join(qc_meanings)})
+    except BaseException:
+        # don't leave a partly written file behind if the input can't be fully converted
+        if nc_file is not None:
+            nc_file.close()
+            os.remove(out_file)
+        raise
 
     # close file
     nc_file.close()
@@ -91,4 +227,6 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--skiprows', type = int, default = 5, help = 'Number of rows in input file to skip before data headers. Default = 5')
     parser.add_argument('-e', '--expected-format', action = 'store_true', help = 'Data in top rows are in expected format. Default = True.')
     args = parser.parse_args()
+    if not os.path.isfile(args.input_file):
+        parser.error(f'input file {args.input_file} does not exist')
     make_ozone_netcdf(args.input_file, out_file = args.outfile, skiprows = args.skiprows, expected_format = args.expected_format)